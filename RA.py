@@ -1,17 +1,111 @@
-import streamlit as st
 import os
+import importlib.util
+
+# Modellcachen måste konfigureras innan htrflow/transformers importeras.
+# HF_HOME pekar på en beständig katalog bredvid appen, och hf_transfer
+# används för parallella nedladdningar om paketet finns installerat.
+os.environ.setdefault("HF_HOME", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".hf_cache"))
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
+import streamlit as st
 import yaml
-import subprocess
+import hashlib
+import copy
+import contextlib
 import tempfile
-import base64
-from pathlib import Path
 import shutil
 import time
+import random
+import zlib
+import uuid
+import atexit
+import queue
+import threading
 import sys
-import importlib
-import io
-import importlib.util
-from PIL import Image
+import platform
+
+# Parallell fil-I/O lönar sig först när batchen har några bilder
+PARALLEL_IO_MIN_BATCH = 4
+PARALLEL_IO_MAX_WORKERS = 8
+
+# Visas när htrflow saknas; transkribering kräver Python API:t
+HTRFLOW_INSTALL_HINT = "Installera med `pip install htrflow` eller kontrollera att det finns i requirements.txt."
+
+# libyaml-baserade säkra C-implementationer när PyYAML är byggt med dem
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Längsta sida i pixlar för bilder som skickas till pipelinen
+MAX_INPUT_DIM = 2048
+
+# Förhandsvisningar skickas som små JPEG-bilder till webbläsaren
+THUMBNAIL_MAX_DIM = 800
+THUMBNAIL_QUALITY = 85
+THUMBNAIL_CACHE_MAX_ENTRIES = 64
+
+# Modeller i standardpipelinen
+SEGMENTATION_MODEL = "Riksarkivet/yolov9-lines-within-regions-1"
+RECOGNITION_MODEL = "Riksarkivet/trocr-base-handwritten-hist-swe-2"
+
+# Antal sidor som YOLO-segmenteringen bearbetar per framåtpass
+SEGMENTATION_BATCH_SIZE = 8
+
+# Antal textrader som TrOCR avkodar per batch; kan ändras i sidokolumnen
+RECOGNITION_BATCH_SIZE = 16
+
+# Standardpipelinen; exportmålet fylls i per session av create_pipeline_config
+PIPELINE_TEMPLATE = {
+    "steps": [
+        {
+            "step": "Segmentation",
+            "settings": {
+                "model": "yolo",
+                "model_settings": {
+                    "model": SEGMENTATION_MODEL
+                },
+                # Segmentera flera sidor per framåtpass i stället för en i taget
+                "generation_settings": {
+                    "batch_size": SEGMENTATION_BATCH_SIZE
+                }
+            }
+        },
+        {
+            "step": "TextRecognition",
+            "settings": {
+                "model": "TrOCR",
+                "model_settings": {
+                    "model": RECOGNITION_MODEL
+                },
+                # Avkoda många textrader per batch med girig sökning
+                "generation_settings": {
+                    "batch_size": RECOGNITION_BATCH_SIZE,
+                    "num_beams": 1
+                }
+            }
+        },
+        {
+            "step": "OrderLines"
+        },
+        {
+            "step": "Export",
+            "settings": {
+                "format": "txt",
+                "dest": None
+            }
+        }
+    ]
+}
+
+# Varje cachad pipeline håller egna kopior av modellerna i minnet
+PIPELINE_CACHE_MAX_ENTRIES = 4
+
+# De delade pipelinerna exporterar hit; resultaten flyttas sedan till sessionens output-katalog
+SHARED_EXPORT_DIR = os.path.join(tempfile.gettempdir(), "ra_htrflow_exports")
+
+# Beständig transkriberingscache, delad mellan sessioner på samma server
+TRANSCRIPTION_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ra_transcription_cache")
+TRANSCRIPTION_CACHE_MAX_ENTRIES = 128
 
 st.set_page_config(
     page_title="Riksarkivets Handskriftstranskribering",
@@ -32,127 +126,593 @@ Läs mer på [Riksarkivets webbplats](https://riksarkivet.se/nyheter-och-press?i
 def initialize_environment():
     """Kontrollerar om HTR Flow är tillgängligt"""
     try:
-        # Kontrollera om HTR Flow är installerat med importförsök
+        # Kontrollera om HTR Flow finns utan att starta något skal
+        if importlib.util.find_spec("htrflow") is None:
+            return False, f"HTR Flow är inte installerat. {HTRFLOW_INSTALL_HINT}"
+        
+        # Versionen läses från paketmetadata så att htrflow inte importeras här
+        import importlib.metadata
         try:
-            import htrflow
-            version = getattr(htrflow, "__version__", "okänd version")
-            return True, f"HTR Flow är installerat (version: {version})"
-        except ImportError:
-            # Försök med kommandoradsversionen
-            cmd_result = subprocess.run(
-                ["which", "htrflow"] if os.name != 'nt' else ["where", "htrflow"],
-                capture_output=True, 
-                text=True, 
-                check=False
-            )
-            
-            if cmd_result.returncode == 0 and cmd_result.stdout.strip():
-                return True, f"HTR Flow kommando hittades: {cmd_result.stdout.strip()}"
-            
-            return False, "HTR Flow är inte installerat. Kontrollera att det är inkluderat i requirements.txt."
+            version = importlib.metadata.version("htrflow")
+        except importlib.metadata.PackageNotFoundError:
+            version = "okänd version"
+        return True, f"HTR Flow är installerat (version: {version})"
     except Exception as e:
         return False, f"Ett fel uppstod vid kontroll av HTR Flow: {str(e)}"
 
-# Skapa eller hämta pipeline.yaml
-def create_pipeline_yaml(output_dir):
-    """Skapar en standard pipeline.yaml-fil"""
-    pipeline_config = {
-        "steps": [
-            {
-                "step": "Segmentation",
-                "settings": {
-                    "model": "yolo",
-                    "model_settings": {
-                        "model": "Riksarkivet/yolov9-lines-within-regions-1"
-                    }
-                }
-            },
-            {
-                "step": "TextRecognition",
-                "settings": {
-                    "model": "TrOCR",
-                    "model_settings": {
-                        "model": "Riksarkivet/trocr-base-handwritten-hist-swe-2"
-                    }
-                }
-            },
-            {
-                "step": "OrderLines"
-            },
-            {
-                "step": "Export",
-                "settings": {
-                    "format": "txt",
-                    "dest": output_dir
-                }
-            }
-        ]
+# Miljöinformation för felsökning; ändras inte medan processen körs
+@st.cache_data(ttl=3600)
+def collect_debug_info():
+    """Samlar Python-version, installerade paket och systemversion utan underprocesser"""
+    import importlib.metadata
+
+    packages = sorted(
+        f"{dist.metadata['Name']} {dist.version}" for dist in importlib.metadata.distributions()
+    )
+    return {
+        "python": sys.version,
+        "packages": packages,
+        "system": platform.platform(),
+        "hf_home": os.environ["HF_HOME"],
     }
+
+# Skapa standardkonfigurationen för pipelinen
+@st.cache_data
+def create_pipeline_config(output_dir, recognition_batch_size=RECOGNITION_BATCH_SIZE):
+    """Skapar standardkonfigurationen för HTR Flow som en dict"""
+    pipeline_config = copy.deepcopy(PIPELINE_TEMPLATE)
+    for step in pipeline_config["steps"]:
+        if step["step"] == "TextRecognition":
+            step["settings"]["generation_settings"]["batch_size"] = recognition_batch_size
+        elif step["step"] == "Export":
+            step["settings"]["dest"] = output_dir
+    
+    return pipeline_config
+
+# Kontrollera en redigerad konfiguration innan den sparas i sessionen
+def is_valid_pipeline_config(pipeline_config):
+    """Returnerar True om konfigurationen är en dict med en lista av steg-dictar"""
+    if not isinstance(pipeline_config, dict):
+        return False
+    steps = pipeline_config.get("steps")
+    return isinstance(steps, list) and all(
+        isinstance(step, dict) and "step" in step and isinstance(step.get("settings", {}), dict)
+        for step in steps
+    )
+
+# YAML-texten behövs bara för visning i sidokolumnen
+@st.cache_data
+def dump_pipeline_yaml(pipeline_config):
+    """Serialiserar pipeline-konfigurationen till YAML"""
+    return yaml.dump(pipeline_config, Dumper=YAML_DUMPER, default_flow_style=False, sort_keys=False)
+
+# Spara en uppladdad fil i bitar så att hela bilden inte kopieras i minnet
+def save_uploaded_file(uploaded_file, dest_dir, saved_files=None):
+    """Skriver en uppladdad fil till disk och returnerar sökvägen"""
+    image_path = os.path.join(dest_dir, uploaded_file.name)
     
-    # Returnera konfigurationen som en sträng
-    return yaml.dump(pipeline_config, default_flow_style=False, sort_keys=False)
+    # saved_files kopplar sökväg till file_id, så samma uppladdning skrivs bara en gång
+    file_id = getattr(uploaded_file, "file_id", None)
+    if saved_files is not None and file_id is not None:
+        if saved_files.get(image_path) == file_id and os.path.exists(image_path):
+            return image_path
+
+    uploaded_file.seek(0)
+    with open(image_path, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, length=1024 * 1024)
+
+    if saved_files is not None and file_id is not None:
+        saved_files[image_path] = file_id
+    return image_path
+
+# Stora skanningar skalas ned innan de skickas till segmenteringen
+def downscale_for_pipeline(image_path):
+    """Returnerar sökvägen till en nedskalad JPEG-kopia om bilden är större än MAX_INPUT_DIM"""
+    from PIL import Image, ImageOps
+
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+    input_dir = os.path.join(os.path.dirname(image_path), "pipeline_inputs")
+    scaled_path = os.path.join(input_dir, f"{base_name}.jpg")
+    if os.path.exists(scaled_path) and os.path.getmtime(scaled_path) >= os.path.getmtime(image_path):
+        return scaled_path
+
+    with Image.open(image_path) as img:
+        if max(img.size) <= MAX_INPUT_DIM:
+            return image_path
+
+        # Låt JPEG-avkodaren hoppa över upplösning som ändå slängs
+        img.draft("RGB", (MAX_INPUT_DIM, MAX_INPUT_DIM))
+
+        # EXIF försvinner vid sparandet, så orienteringen måste tillämpas först
+        upright = ImageOps.exif_transpose(img)
+        upright.thumbnail((MAX_INPUT_DIM, MAX_INPUT_DIM), Image.LANCZOS)
+        os.makedirs(input_dir, exist_ok=True)
+        upright.convert("RGB").save(scaled_path, "JPEG", quality=92)
+    return scaled_path
+
+# Nedskalad förhandsvisning så att stora skanningar inte skickas till webbläsaren
+@st.cache_data(show_spinner=False, max_entries=THUMBNAIL_CACHE_MAX_ENTRIES)
+def thumbnail(image_path, mtime, max_dim=THUMBNAIL_MAX_DIM):
+    """Returnerar en JPEG-miniatyr av bilden; mtime ingår i cachenyckeln"""
+    import io
+    from PIL import Image, ImageOps
+
+    with Image.open(image_path) as img:
+        img.draft("RGB", (max_dim, max_dim))
+        upright = ImageOps.exif_transpose(img)
+        upright.thumbnail((max_dim, max_dim))
+        buffer = io.BytesIO()
+        upright.convert("RGB").save(buffer, "JPEG", quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+# Visa en uppladdad bild
+def display_image(image_path):
+    """Visar en cachad miniatyr av bilden"""
+    st.image(thumbnail(image_path, os.path.getmtime(image_path)), use_container_width=True)
+
+# Läs en exporterad transkribering
+def read_text_file(path):
+    """Läser en textfil som UTF-8"""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+# Kör I/O-bunden filhantering parallellt för större batchar
+def map_io(func, items):
+    """Tillämpar func på items, i en trådpool när batchen är tillräckligt stor"""
+    if len(items) < PARALLEL_IO_MIN_BATCH:
+        return [func(item) for item in items]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(PARALLEL_IO_MAX_WORKERS, len(items))) as executor:
+        return list(executor.map(func, items))
+
+# Indexera exportfilerna en gång i stället för att söka igenom katalogen per bild
+def index_output_files(output_dir):
+    """Returnerar en dict från filnamn utan ändelse till sökväg för alla .txt-filer"""
+    output_index = {}
+    for root, _, files in os.walk(output_dir):
+        for file in files:
+            if file.endswith(".txt"):
+                output_index.setdefault(os.path.splitext(file)[0], os.path.join(root, file))
+    return output_index
+
+# Hitta exportfilerna för en eller flera bilder, även när htrflow lagt dem i underkataloger
+def find_output_files(output_dir, base_names):
+    """Returnerar en dict från filnamn utan ändelse till sökväg; katalogen indexeras högst en gång"""
+    output_paths = {}
+    output_index = None
+    for base_name in base_names:
+        output_path = os.path.join(output_dir, f"{base_name}.txt")
+        if not os.path.isfile(output_path):
+            if output_index is None:
+                output_index = index_output_files(output_dir)
+            output_path = output_index.get(base_name)
+        if output_path:
+            output_paths[base_name] = output_path
+    return output_paths
+
+# htrflow drar in torch och transformers; importeras först vid första riktiga transkriberingen
+@st.cache_resource
+def _load_htrflow():
+    """Importerar htrflow och returnerar modulen och Pipeline-klassen"""
+    import htrflow
+    from htrflow.pipeline import Pipeline
+
+    return htrflow, Pipeline
+
+# TrOCR:s batchstorlek sätts per körning och ingår inte i några cachenycklar
+def pipeline_batch_size(pipeline_config):
+    """Returnerar batch_size i TextRecognition-stegets generation_settings, eller None"""
+    for step in pipeline_config.get("steps", []):
+        if step.get("step") == "TextRecognition":
+            generation_settings = (step.get("settings") or {}).get("generation_settings")
+            if isinstance(generation_settings, dict):
+                return generation_settings.get("batch_size")
+    return None
+
+# Ta bort batchstorleken ur en kopia av stegen innan de används som nyckel
+def drop_recognition_batch_size(steps):
+    """Tar bort batch_size ur TextRecognition-stegets generation_settings"""
+    for step in steps:
+        if step.get("step") == "TextRecognition":
+            generation_settings = (step.get("settings") or {}).get("generation_settings")
+            if isinstance(generation_settings, dict):
+                generation_settings.pop("batch_size", None)
+
+# Sessionens exportmål och batchstorlek får inte ingå i pipelinens cachenyckel
+def shared_pipeline_config(pipeline_config):
+    """Returnerar en kopia av konfigurationen som exporterar till SHARED_EXPORT_DIR"""
+    shared_config = copy.deepcopy(pipeline_config)
+    for step in shared_config.get("steps", []):
+        if step.get("step") == "Export":
+            step["settings"] = {**(step.get("settings") or {}), "dest": SHARED_EXPORT_DIR}
+    drop_recognition_batch_size(shared_config.get("steps", []))
+    return shared_config
+
+# Sätt TrOCR:s batchstorlek på den delade pipelinen inför en körning
+def set_recognition_batch_size(pipeline, batch_size):
+    """Uppdaterar generation_kwargs i pipelinens TextRecognition-steg"""
+    for step in getattr(pipeline, "steps", []):
+        generation_kwargs = getattr(step, "generation_kwargs", None)
+        if type(step).__name__ == "TextRecognition" and isinstance(generation_kwargs, dict):
+            if batch_size is None:
+                generation_kwargs.pop("batch_size", None)
+            else:
+                generation_kwargs["batch_size"] = batch_size
+
+# Pipelinen och dess modeller delas av alla sessioner med samma modellkonfiguration
+def get_pipeline(pipeline_config, use_onnx=False):
+    """Returnerar den delade HTR Flow-pipelinen för konfigurationen"""
+    return _build_pipeline(shared_pipeline_config(pipeline_config), use_onnx)
+
+@st.cache_resource(max_entries=PIPELINE_CACHE_MAX_ENTRIES)
+def _build_pipeline(pipeline_config, use_onnx=False):
+    """Skapar en HTR Flow-pipeline som återanvänds mellan omkörningar och sessioner"""
+    _, Pipeline = _load_htrflow()
+
+    # Pipeline tar en lista av steg; from_config plockar bort nycklar ur dicten den får,
+    # så den får en kopia och apply_onnx_trocr kan läsa model_settings ur originalet
+    pipeline = Pipeline.from_config(copy.deepcopy(pipeline_config))
+    # Ett fel här cachas inte, så run_transcription rapporterar det och förladdningen varnar
+    if use_onnx and not apply_onnx_trocr(pipeline, pipeline_config):
+        raise RuntimeError("ONNX valdes men pipelinen har inget TrOCR-steg som kan köras med ONNX Runtime.")
+
+    # htrflow laddar stegens modeller först vid första körningen; ladda dem här så att
+    # förladdningen och den delade cacheposten faktiskt håller vikterna i minnet
+    for step in pipeline.steps:
+        if getattr(step, "model_class", None) is not None and getattr(step, "model", None) is None:
+            step._init_model()
+    return pipeline
+
+# Inställningar för ONNX Runtime-sessioner
+def onnx_runtime_options():
+    """Returnerar provider och sessionsinställningar för ORTModel.from_pretrained"""
+    import onnxruntime as ort
+
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    # CUDA när en GPU finns, annars CPU
+    if "CUDAExecutionProvider" not in ort.get_available_providers():
+        return {"provider": "CPUExecutionProvider", "session_options": session_options}
+
+    # Standardvärdet för cuDNN:s algoritmsökning lämnar mycket prestanda oanvänd
+    return {
+        "provider": "CUDAExecutionProvider",
+        "provider_options": {
+            "cudnn_conv_algo_search": "EXHAUSTIVE",
+            "do_copy_in_default_stream": True,
+        },
+        "session_options": session_options,
+    }
+
+# TrOCR exporterad till ONNX Runtime; kräver det valfria paketet optimum
+@st.cache_resource
+def load_onnx_trocr(model_name):
+    """Exporterar TrOCR till ONNX en gång, sparar under HF_HOME och laddar med ONNX Runtime"""
+    from optimum.onnxruntime import ORTModelForVision2Seq
+
+    ort_kwargs = onnx_runtime_options()
+    export_dir = os.path.join(os.environ["HF_HOME"], "onnx", model_name.replace("/", "--"))
+    if os.path.isdir(export_dir):
+        return ORTModelForVision2Seq.from_pretrained(export_dir, **ort_kwargs)
+
+    model = ORTModelForVision2Seq.from_pretrained(model_name, export=True, **ort_kwargs)
+
+    # Spara i en temporär katalog och flytta den på plats, så att en avbruten export
+    # aldrig lämnar en halvfärdig katalog som ser klar ut
+    os.makedirs(os.path.dirname(export_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(export_dir), prefix=".export-")
+    try:
+        model.save_pretrained(tmp_dir)
+        os.replace(tmp_dir, export_dir)
+    except OSError:
+        # En annan process hann först; dess export används nästa gång
+        pass
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return model
+
+# Byt ut PyTorch-modellen i pipelinens TrOCR-steg mot ONNX-versionen
+def apply_onnx_trocr(pipeline, pipeline_config):
+    """Ersätter TrOCR-modellen i TextRecognition-steget; returnerar False om steget saknas"""
+    model_name = RECOGNITION_MODEL
+    for step in pipeline_config.get("steps", []):
+        if step.get("step") == "TextRecognition":
+            model_settings = (step.get("settings") or {}).get("model_settings") or {}
+            model_name = model_settings.get("model", model_name)
+
+    for step in getattr(pipeline, "steps", []):
+        # htrflow laddar stegens modeller först vid första körningen
+        if getattr(step, "model", None) is None and getattr(getattr(step, "model_class", None), "__name__", "") == "TrOCR":
+            step._init_model()
+        recognizer = getattr(step, "model", None)
+        if type(recognizer).__name__ == "TrOCR":
+            recognizer.model = load_onnx_trocr(model_name)
+            # htrflow binder compute_transition_scores till PyTorch-avkodaren, som annars
+            # skulle ligga kvar i minnet bredvid ONNX-modellen
+            recognizer.compute_transition_scores = recognizer.model.compute_transition_scores
+            free_cuda_cache()
+            return True
+    return False
+
+# Lämna tillbaka GPU-minne från modeller som inte längre används
+def free_cuda_cache():
+    """Tömmer PyTorch:s CUDA-cache om en GPU finns"""
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+# Halv precision för snabbare TrOCR-avkodning på GPU
+def inference_precision(precision):
+    """Returnerar en kontext som kör inferensen i float16/bfloat16 på CUDA när det är valt"""
+    if precision in ("float16", "bfloat16"):
+        import torch
+        if torch.cuda.is_available():
+            # bfloat16 kräver Ampere eller senare
+            if precision == "bfloat16" and not torch.cuda.is_bf16_supported():
+                return contextlib.nullcontext()
+            return torch.autocast("cuda", dtype=getattr(torch, precision))
+    return contextlib.nullcontext()
+
+# htrflow exporterar till <dest>/<collection.label>/<sida>.txt; varje jobb får en egen underkatalog
+def run_pipeline(pipeline, job_image_paths):
+    """Kör pipelinen och lägger varje jobbs exportfiler i en egen underkatalog till SHARED_EXPORT_DIR"""
+    from htrflow.volume.volume import Collection
+
+    # Jobbets katalognamn är namnet på dess staging-katalog
+    job_labels = [os.path.basename(os.path.dirname(paths[0])) for paths in job_image_paths]
+    if len(job_image_paths) == 1:
+        pipeline.run(Collection(job_image_paths[0], label=job_labels[0]))
+        return
+
+    # Sammanslagna jobb exporteras under en tillfällig etikett och sorteras sedan ut per jobb
+    run_label = f"ra_run_{uuid.uuid4().hex}"
+    run_dir = os.path.join(SHARED_EXPORT_DIR, run_label)
+    owners = {
+        os.path.splitext(os.path.basename(path))[0]: job_label
+        for paths, job_label in zip(job_image_paths, job_labels)
+        for path in paths
+    }
+    try:
+        pipeline.run(Collection([path for paths in job_image_paths for path in paths], label=run_label))
+        if os.path.isdir(run_dir):
+            with os.scandir(run_dir) as entries:
+                for entry in entries:
+                    job_label = owners.get(os.path.splitext(entry.name)[0])
+                    if job_label:
+                        job_dir = os.path.join(SHARED_EXPORT_DIR, job_label)
+                        os.makedirs(job_dir, exist_ok=True)
+                        os.replace(entry.path, os.path.join(job_dir, entry.name))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+# Långlivad inferenstråd; samtidiga jobb från olika sessioner mot samma delade pipeline körs ihop
+class TranscriptionWorker:
+    """Kör pipeline.run i en bakgrundstråd och slår ihop köade jobb till en körning"""
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        # Starta (om) tråden; utan levande tråd skulle köade jobb vänta för evigt
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="htrflow-worker", daemon=True)
+                self.thread.start()
+
+    def submit(self, pipeline, image_paths, precision="float32", batch_size=None):
+        """Köar bilderna och returnerar en Future som blir klar när de är transkriberade"""
+        from concurrent.futures import Future
+
+        future = Future()
+        self.jobs.put((pipeline, list(image_paths), precision, batch_size, future))
+        self._ensure_thread()
+        return future
+
+    def _run(self):
+        while True:
+            # Vänta på ett jobb och ta sedan med allt som redan står i kön
+            jobs = [self.jobs.get()]
+            while True:
+                try:
+                    jobs.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Jobb med samma pipeline, precision och batchstorlek körs som en enda batch
+            groups = {}
+            for job in jobs:
+                groups.setdefault((id(job[0]), job[2], job[3]), []).append(job)
+
+            for group in groups.values():
+                self._run_group(group)
+
+    def _run_group(self, group):
+        pipeline, _, precision, batch_size, _ = group[0]
+        try:
+            set_recognition_batch_size(pipeline, batch_size)
+            with inference_precision(precision):
+                run_pipeline(pipeline, [job[1] for job in group])
+        except BaseException as e:
+            # En trasig bild ska inte fälla andra sessioners jobb; kör om dem ett i taget
+            if len(group) > 1:
+                for job in group:
+                    self._run_group([job])
+                return
+
+            # Även SystemExit m.fl. måste lösa jobbets Future, annars blockerar result();
+            # de lämnas vidare som vanliga fel så att sessionen kan rapportera dem
+            if not isinstance(e, Exception):
+                e = RuntimeError(f"Inferenstråden avbröts: {e!r}")
+            group[0][4].set_exception(e)
+        else:
+            for job in group:
+                job[4].set_result(None)
+
+# En arbetstråd per process, delad av alla sessioner
+@st.cache_resource
+def get_transcription_worker():
+    """Startar inferenstråden första gången den behövs"""
+    return TranscriptionWorker()
+
+# Sammanslagna jobb exporteras först till samma katalog, så varje jobb får unika filnamn
+def stage_job_inputs(image_paths, staging_dir):
+    """Länkar eller kopierar bilderna till staging_dir; returnerar sökvägarna och exportnamn -> ursprungligt namn"""
+    job_id = uuid.uuid4().hex
+    staged_paths = []
+    export_names = {}
+    for image_path in image_paths:
+        base_name, ext = os.path.splitext(os.path.basename(image_path))
+        export_name = f"{job_id}_{base_name}"
+        staged_path = os.path.join(staging_dir, f"{export_name}{ext}")
+        try:
+            os.link(image_path, staged_path)
+        except OSError:
+            shutil.copyfile(image_path, staged_path)
+        staged_paths.append(staged_path)
+        export_names[export_name] = base_name
+    return staged_paths, export_names
 
 # Funktion som kör transkriberingen
-def run_transcription(image_path, pipeline_path):
-    """Kör HTR Flow för att transkribera bilden"""
+def run_transcription(image_paths, pipeline_config, output_dir, precision="float32", use_onnx=False):
+    """Kör HTR Flow för att transkribera en eller flera bilder i en och samma körning"""
+    # Python API krävs - kommandoradsversionen laddar om alla modeller vid varje anrop
+    try:
+        _load_htrflow()
+    except ImportError as e:
+        st.error(f"HTR Flow Python API krävs för transkribering: {e}. {HTRFLOW_INSTALL_HINT}")
+        st.stop()
+
+    staging_dir = tempfile.mkdtemp(prefix="ra_job_")
+    export_dir = os.path.join(SHARED_EXPORT_DIR, os.path.basename(staging_dir))
     try:
-        # Försök först att importera och använda Python API direkt
+        st.info("Använder HTR Flow Python API")
+
+        # Hämta den delade pipelinen och låt bakgrundstråden köra den
+        staged_paths, export_names = stage_job_inputs(image_paths, staging_dir)
+        pipeline = get_pipeline(pipeline_config, use_onnx)
         try:
-            import htrflow
-            from htrflow.pipeline import Pipeline
-            
-            st.info("Använder HTR Flow Python API")
-            
-            # Läs pipeline-konfiguration
-            with open(pipeline_path, 'r') as f:
-                pipeline_config = yaml.safe_load(f)
-            
-            # Skapa och kör pipeline
-            pipeline = Pipeline(pipeline_config)
-            pipeline.run([image_path])
-            
-            return True, "Transkribering slutförd med Python API", ""
-            
-        except (ImportError, AttributeError) as e:
-            st.warning(f"Kunde inte använda Python API: {e}. Försöker med kommandoradsversionen.")
-            
-            # Fallback till kommandoradsversionen
-            command = f"htrflow pipeline {pipeline_path} {image_path}"
-            
-            # Kör kommandot och fånga utdata
-            result = subprocess.run(
-                command, 
-                shell=True, 
-                capture_output=True, 
-                text=True, 
-                check=True
-            )
-            
-            return True, result.stdout, result.stderr
+            get_transcription_worker().submit(
+                pipeline, staged_paths, precision, pipeline_batch_size(pipeline_config)
+            ).result()
+        finally:
+            # Flytta jobbets exportfiler från dess underkatalog till sessionens output-katalog
+            for export_name, base_name in export_names.items():
+                export_path = os.path.join(export_dir, f"{export_name}.txt")
+                if os.path.isfile(export_path):
+                    shutil.move(export_path, os.path.join(output_dir, f"{base_name}.txt"))
+        
+        return True, "Transkribering slutförd med Python API", ""
             
-    except subprocess.CalledProcessError as e:
-        return False, e.stdout, e.stderr
     except Exception as e:
         import traceback
         tb = traceback.format_exc()
         return False, "", f"{str(e)}\n\n{tb}"
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        shutil.rmtree(export_dir, ignore_errors=True)
 
-# Skapa en mock-implementation för demo-läge
-def create_mock_module(temp_dir):
-    """Skapar en mock-implementation av HTR Flow för demo-läge"""
-    mock_module_path = os.path.join(temp_dir, "mock_htrflow.py")
-    
-    mock_code = """
-# Mock-implementation av HTR Flow transkribering
-import os
-import time
-import random
-import yaml
+# Fingeravtryck av pipelinen utan exportmålet och batchstorleken, som inte påverkar texten
+def pipeline_fingerprint(pipeline_config, precision="float32", use_onnx=False):
+    """Returnerar en hash av pipeline-stegen och inferensvalen som påverkar transkriberingen"""
+    steps = copy.deepcopy([step for step in pipeline_config.get("steps", []) if step.get("step") != "Export"])
+    drop_recognition_batch_size(steps)
+    key = {"steps": steps, "precision": precision, "onnx": use_onnx}
+    return hashlib.sha256(yaml.dump(key, Dumper=YAML_DUMPER, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Sökväg i transkriberingscachen för en bild och en pipeline
+def transcription_cache_path(image_path, fingerprint):
+    """Nyckeln är sha256 av bildens innehåll och pipelinens fingeravtryck"""
+    digest = hashlib.sha256(fingerprint.encode("utf-8"))
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return os.path.join(TRANSCRIPTION_CACHE_DIR, f"{digest.hexdigest()}.txt")
+
+# Spara en transkribering i cachen och rensa bort de äldsta posterna
+def store_cached_transcription(cache_path, text):
+    """Skriver en post till transkriberingscachen"""
+    os.makedirs(TRANSCRIPTION_CACHE_DIR, exist_ok=True)
+
+    # Unik temporärfil per skrivare, eftersom cachen delas av alla sessioner
+    fd, tmp_path = tempfile.mkstemp(dir=TRANSCRIPTION_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+
+    # Andra sessioner kan ta bort poster medan vi listar dem
+    entries = []
+    for entry in os.scandir(TRANSCRIPTION_CACHE_DIR):
+        if entry.name.endswith(".txt"):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+    entries.sort()
+    for _, path in entries[:-TRANSCRIPTION_CACHE_MAX_ENTRIES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# Transkribera via cachen så att identiska bilder inte körs genom pipelinen igen
+def transcribe_with_cache(image_paths, pipeline_config, output_dir, precision="float32", use_onnx=False):
+    """Kör run_transcription endast för bilder som saknas i transkriberingscachen"""
+    fingerprint = pipeline_fingerprint(pipeline_config, precision, use_onnx)
+    image_paths = map_io(downscale_for_pipeline, image_paths)
+
+    # Cachade resultat skrivs till output-katalogen precis som pipelinens export
+    missing = {}
+    for image_path in image_paths:
+        base_name = os.path.splitext(os.path.basename(image_path))[0]
+        cache_path = transcription_cache_path(image_path, fingerprint)
+        try:
+            shutil.copyfile(cache_path, os.path.join(output_dir, f"{base_name}.txt"))
+        except OSError:
+            # Saknas eller rensades nyss av en annan session - räknas som en miss
+            missing[base_name] = (image_path, cache_path)
+
+    if not missing:
+        return True, f"Alla {len(image_paths)} bilder hämtades från cachen", ""
+
+    # Ta bort resultat från tidigare körningar, så att bara denna körnings filer cachas
+    for base_name in missing:
+        try:
+            os.remove(os.path.join(output_dir, f"{base_name}.txt"))
+        except FileNotFoundError:
+            pass
+
+    success, stdout, stderr = run_transcription(
+        [path for path, _ in missing.values()], pipeline_config, output_dir, precision, use_onnx
+    )
+    if success:
+        # run_transcription flyttar exporten direkt till <output_dir>/<namn>.txt
+        for base_name, (_, cache_path) in missing.items():
+            output_path = os.path.join(output_dir, f"{base_name}.txt")
+            if os.path.isfile(output_path):
+                store_cached_transcription(cache_path, read_text_file(output_path))
+
+    return success, stdout, stderr
 
+# Mock-implementation av HTR Flow för demo-läge
 class MockTranscriber:
+    """Simulerar transkribering genom att skriva en av några exempeltexter"""
+
     def __init__(self):
         self.demo_texts = [
-            \"\"\"Monmouth den 29 1882.
+            """Monmouth den 29 1882.
 
 Platskade Syster emot Svåger
 Hå godt är min önskan
@@ -169,8 +729,8 @@ voro att dessa rader trefar
 eder vid samma goda gofva.
 och jag får önska eder lycka
 på det nya åratt samt god
-fortsättning på detsamma.\"\"\",
-            \"\"\"Stockholm den 15 juli 1876
+fortsättning på detsamma.""",
+            """Stockholm den 15 juli 1876
             
 Kära Syster!
 Hjärtligt tack för Ditt bref
@@ -184,7 +744,7 @@ kunna besöka Eder i Augusti
 om allt går som planerat.
 Hälsa alla från mig!
 Din tillgifne broder,
-Carl\"\"\"
+Carl"""
         ]
     
     def transcribe(self, image_path, output_dir):
@@ -193,7 +753,7 @@ Carl\"\"\"
         
         # Välj en text baserat på filnamnet (deterministiskt)
         image_name = os.path.basename(image_path)
-        hash_value = sum(ord(c) for c in image_name)
+        hash_value = zlib.crc32(image_name.encode("utf-8"))
         text_index = hash_value % len(self.demo_texts)
         
         # Hämta texten
@@ -211,98 +771,11 @@ Carl\"\"\"
         
         return output_path
 
-def mock_run_pipeline(pipeline_path, image_paths):
-    # Läs pipeline-konfigurationen för att få utdatamappen
-    with open(pipeline_path, "r", encoding="utf-8") as f:
-        pipeline_config = yaml.safe_load(f)
-    
-    # Hitta export-steget för att få utdatamappen
-    output_dir = None
-    for step in pipeline_config.get("steps", []):
-        if step.get("step") == "Export" and "settings" in step:
-            output_dir = step["settings"].get("dest")
-            break
-    
-    if not output_dir:
-        output_dir = os.path.join(os.path.dirname(image_paths[0]), "outputs")
-        os.makedirs(output_dir, exist_ok=True)
-    
-    # Skapa en mock-transkribering för varje bild
-    transcriber = MockTranscriber()
-    for image_path in image_paths:
-        transcriber.transcribe(image_path, output_dir)
-    
-    return True
-"""
-    
-    with open(mock_module_path, "w", encoding="utf-8") as f:
-        f.write(mock_code)
-    
-    return mock_module_path
-
-# Huvudapp
-def main():
-    # Visa versionsinformation och miljö
-    st.sidebar.header("Systeminformation")
-    
-    # Kontrollera om HTR Flow är tillgängligt
-    success, message = initialize_environment()
-    if success:
-        st.sidebar.success(message)
-    else:
-        st.sidebar.error(message)
-        st.sidebar.warning("""
-        För att köra denna app med full funktionalitet behöver HTR Flow vara installerat.
-        Appen kommer köras i demo-läge.
-        """)
-        
-        # Visa debug-information
-        with st.sidebar.expander("Debug-information"):
-            st.code(f"Python version: {os.popen('python --version').read()}")
-            st.code(f"Installerade paket:\n{os.popen('pip list').read()}")
-            st.code(f"Systemversion: {os.popen('uname -a').read() if os.name != 'nt' else os.popen('ver').read()}")
-    
-    # Skapa temporära mappar för arbetet
-    temp_dir = tempfile.mkdtemp()
-    output_dir = os.path.join(temp_dir, "outputs")
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Skapa pipeline.yaml
-    pipeline_content = create_pipeline_yaml(output_dir)
-    pipeline_path = os.path.join(temp_dir, "pipeline.yaml")
-    
-    with open(pipeline_path, "w") as f:
-        f.write(pipeline_content)
-    
-    # Skapa mock-modul för demo-läge
-    create_mock_module(temp_dir)
-    
-    # Visa konfigurationen i sidokolumnen
-    with st.sidebar:
-        st.header("Konfiguration")
-        
-        # Välj om demo-läge ska användas
-        use_demo = st.checkbox("Använd demo-läge", value=not success)
-        if use_demo:
-            st.info("Demo-läge aktiverat. Transkribering simuleras utan att använda HTR Flow.")
-        
-        with st.expander("Pipeline-konfiguration"):
-            st.code(pipeline_content, language="yaml")
-            
-            # Möjlighet att anpassa konfigurationen (enkel version)
-            if st.checkbox("Anpassa pipeline-konfigurationen"):
-                custom_pipeline = st.text_area(
-                    "Redigera pipeline.yaml (avancerat)", 
-                    value=pipeline_content,
-                    height=400
-                )
-                
-                if st.button("Uppdatera konfiguration"):
-                    with open(pipeline_path, "w") as f:
-                        f.write(custom_pipeline)
-                    st.success("Konfigurationen har uppdaterats!")
-    
-    # Huvudinnehållet - uppladdning och transkribering
+# Uppladdning och transkribering körs som ett fragment, så att uppladdningar och
+# knapptryck här bara kör om panelen och inte hela appen
+@st.fragment
+def transcribe_panel(temp_dir, output_dir, saved_files, pipeline_config, use_demo, precision, use_onnx):
+    """Visar uppladdning, transkribering och resultat för enskilda bilder och batchar"""
     st.header("Ladda upp en bild för transkribering")
     
     # Uppladdning av bild
@@ -315,14 +788,12 @@ def main():
         # Visa originalbild
         col1, col2 = st.columns(2)
         
+        # Spara den uppladdade filen
+        image_path = save_uploaded_file(uploaded_file, temp_dir, saved_files)
+        
         with col1:
             st.subheader("Originalbild")
-            st.image(uploaded_file, use_column_width=True)
-        
-        # Spara den uppladdade filen
-        image_path = os.path.join(temp_dir, uploaded_file.name)
-        with open(image_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+            display_image(image_path)
         
         # Transkribera bilden när användaren klickar på knappen
         if st.button("Transkribera bilden"):
@@ -335,17 +806,8 @@ def main():
                     st.info("Använder demo-läge för transkribering")
                     
                     try:
-                        # Läs in mock-modulen
-                        sys.path.insert(0, temp_dir)
-                        
-                        import importlib.util
-                        mock_module_path = os.path.join(temp_dir, "mock_htrflow.py")
-                        spec = importlib.util.spec_from_file_location("mock_htrflow", mock_module_path)
-                        mock_htrflow = importlib.util.module_from_spec(spec)
-                        spec.loader.exec_module(mock_htrflow)
-                        
                         # Skapa en instans av MockTranscriber och transkribera bilden
-                        transcriber = mock_htrflow.MockTranscriber()
+                        transcriber = MockTranscriber()
                         mock_output_path = transcriber.transcribe(image_path, output_dir)
                         
                         success = True
@@ -358,7 +820,9 @@ def main():
                         stderr = f"Fel vid körning av demo-transkribering: {str(e)}\n{traceback.format_exc()}"
                 else:
                     # Kör transkriberingen med verklig HTR Flow
-                    success, stdout, stderr = run_transcription(image_path, pipeline_path)
+                    success, stdout, stderr = transcribe_with_cache(
+                        [image_path], pipeline_config, output_dir, precision, use_onnx
+                    )
                 
                 # Processen är klar
                 process_time = time.time() - start_time
@@ -368,9 +832,9 @@ def main():
                     
                     # Hitta den transkriberade filen
                     base_name = os.path.splitext(uploaded_file.name)[0]
-                    output_file = os.path.join(output_dir, f"{base_name}.txt")
+                    output_file = find_output_files(output_dir, [base_name]).get(base_name)
                     
-                    if os.path.exists(output_file):
+                    if output_file:
                         # Läs in resultatet
                         with open(output_file, "r", encoding="utf-8") as f:
                             transcribed_text = f.read()
@@ -378,7 +842,7 @@ def main():
                         # Visa resultatet
                         with col2:
                             st.subheader("Transkriberad text")
-                            st.text_area("", transcribed_text, height=400)
+                            st.code(transcribed_text, language=None)
                             
                             # Skapa nedladdningsknapp för texten
                             st.download_button(
@@ -389,37 +853,246 @@ def main():
                             )
                     else:
                         st.error("Kunde inte hitta den transkriberade filen.")
-                        st.code(f"Sökte efter: {output_file}")
+                        st.code(f"Sökte efter: {os.path.join(output_dir, base_name + '.txt')}")
                         
-                        # Lista alla filer i output-katalogen
-                        st.write("Filer i output-katalogen:")
-                        all_files = []
-                        for root, _, files in os.walk(output_dir):
-                            for file in files:
-                                all_files.append(os.path.join(root, file))
+                        # Lista textfilerna i output-katalogen med en enda scandir, utan rekursion
+                        st.write("Textfiler i output-katalogen:")
+                        with os.scandir(output_dir) as entries:
+                            txt_files = sorted(
+                                entry.name for entry in entries
+                                if entry.name.endswith(".txt") and entry.is_file()
+                            )
                         
-                        if all_files:
-                            for file_path in all_files:
-                                st.write(f"- {file_path}")
+                        if txt_files:
+                            for file_name in txt_files:
+                                st.write(f"- {file_name}")
                         else:
-                            st.write("Inga filer hittades i output-katalogen.")
+                            st.write("Inga textfiler hittades i output-katalogen.")
                 else:
                     st.error("Transkriberingen misslyckades.")
                     
                     with st.expander("Visa felmeddelande"):
                         st.code(stdout)
                         st.code(stderr)
-    
-    # Rensa temporära filer när appen stängs
+
+    # Batchtranskribering - alla bilder skickas genom pipelinen i en enda körning
+    st.header("Transkribera flera bilder")
+
+    batch_files = st.file_uploader(
+        "Välj bilder att transkribera",
+        type=["jpg", "jpeg", "png", "tif", "tiff"],
+        accept_multiple_files=True,
+        key="batch_uploader"
+    )
+
+    if batch_files and st.button("Transkribera alla bilder"):
+        progress_bar = st.progress(0.0, text="Sparar bilderna...")
+
+        # Spara alla uppladdade filer innan pipelinen körs
+        image_paths = map_io(
+            lambda uploaded_file: save_uploaded_file(uploaded_file, temp_dir, saved_files), batch_files
+        )
+
+        progress_bar.progress(0.1, text=f"Transkriberar {len(image_paths)} bilder...")
+        start_time = time.time()
+
+        with st.spinner("Transkriberar... Detta kan ta några minuter."):
+            if use_demo:
+                try:
+                    transcriber = MockTranscriber()
+                    for image_path in image_paths:
+                        transcriber.transcribe(image_path, output_dir)
+
+                    success, stdout, stderr = True, "Demo-transkribering slutförd.", ""
+                except Exception as e:
+                    import traceback
+                    success = False
+                    stdout = ""
+                    stderr = f"Fel vid körning av demo-transkribering: {str(e)}\n{traceback.format_exc()}"
+            else:
+                # En enda körning låter Segmentation och TextRecognition arbeta i batchar
+                success, stdout, stderr = transcribe_with_cache(
+                    image_paths, pipeline_config, output_dir, precision, use_onnx
+                )
+
+        process_time = time.time() - start_time
+        progress_bar.progress(1.0, text="Klar")
+
+        if success:
+            import io
+            import zipfile
+
+            st.success(f"{len(image_paths)} bilder transkriberades på {process_time:.2f} sekunder!")
+
+            # Slå upp varje exportfil direkt; katalogen indexeras högst en gång
+            output_paths = find_output_files(
+                output_dir, [os.path.splitext(os.path.basename(path))[0] for path in image_paths]
+            )
+
+            results = dict(zip(output_paths, map_io(read_text_file, list(output_paths.values()))))
+
+            for image_path in image_paths:
+                base_name = os.path.splitext(os.path.basename(image_path))[0]
+                with st.expander(base_name):
+                    if base_name in results:
+                        st.code(results[base_name], language=None)
+                    else:
+                        st.error("Kunde inte hitta den transkriberade filen.")
+
+            if results:
+                # En komprimerad fil per bild i stället för en sammanslagen textsträng
+                zip_buffer = io.BytesIO()
+                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+                    for base_name, text in results.items():
+                        zip_file.writestr(f"{base_name}_transkribering.txt", text)
+
+                st.download_button(
+                    label="Ladda ner alla transkriberingar (ZIP)",
+                    data=zip_buffer.getvalue(),
+                    file_name="transkriberingar.zip",
+                    mime="application/zip"
+                )
+        else:
+            st.error("Transkriberingen misslyckades.")
+
+            with st.expander("Visa felmeddelande"):
+                st.code(stdout)
+                st.code(stderr)
+
+# Sessionernas temporära kataloger rensas av en enda atexit-hanterare per process
+@st.cache_resource
+def get_session_temp_dirs():
+    """Returnerar mängden temporära kataloger som ska tas bort när processen avslutas"""
+    temp_dirs = set()
+
     def cleanup():
-        try:
-            shutil.rmtree(temp_dir)
-        except:
-            pass
-    
-    # Registrera upprensningsfunktionen
-    import atexit
+        for temp_dir in list(temp_dirs):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
     atexit.register(cleanup)
+    return temp_dirs
+
+# Huvudapp
+def main():
+    # Visa versionsinformation och miljö
+    st.sidebar.header("Systeminformation")
+    
+    # Kontrollera om HTR Flow är tillgängligt
+    success, message = initialize_environment()
+    if success:
+        st.sidebar.success(message)
+    else:
+        st.sidebar.error(message)
+        st.sidebar.warning("""
+        För att köra denna app med full funktionalitet behöver HTR Flow vara installerat.
+        Appen kommer köras i demo-läge.
+        """)
+        
+        # Visa debug-information
+        with st.sidebar.expander("Debug-information"):
+            debug_info = collect_debug_info()
+            st.code(f"Python version: {debug_info['python']}")
+            st.code("Installerade paket:\n" + "\n".join(debug_info["packages"]))
+            st.code(f"Systemversion: {debug_info['system']}")
+            st.code(f"Modellcache (HF_HOME): {debug_info['hf_home']}")
+    
+    # Skapa temporära mappar för arbetet, en gång per session
+    if "temp_dir" not in st.session_state:
+        session_temp_dir = tempfile.mkdtemp()
+        st.session_state.temp_dir = session_temp_dir
+        st.session_state.output_dir = os.path.join(session_temp_dir, "outputs")
+        st.session_state.saved_files = {}
+        os.makedirs(st.session_state.output_dir, exist_ok=True)
+        
+        # Rensa katalogen när appen stängs
+        get_session_temp_dirs().add(session_temp_dir)
+    
+    temp_dir = st.session_state.temp_dir
+    output_dir = st.session_state.output_dir
+    saved_files = st.session_state.saved_files
+    
+    # Visa konfigurationen i sidokolumnen
+    with st.sidebar:
+        st.header("Konfiguration")
+        
+        # Välj om demo-läge ska användas
+        use_demo = st.checkbox("Använd demo-läge", value=not success)
+        if use_demo:
+            st.info("Demo-läge aktiverat. Transkribering simuleras utan att använda HTR Flow.")
+        
+        # Halv precision gäller bara när en CUDA-GPU finns
+        precision = st.selectbox(
+            "Precision för inferens",
+            options=["float32", "float16", "bfloat16"],
+            index=0,
+            help="float16/bfloat16 ger snabbare inferens på GPU. bfloat16 kräver "
+                 "Ampere eller senare. Ingen effekt på CPU."
+        )
+        
+        # ONNX Runtime för TrOCR; exporten görs vid första användningen
+        use_onnx = st.checkbox(
+            "Snabb inferens (ONNX)",
+            value=False,
+            help="Exporterar TrOCR till ONNX Runtime (CUDA om GPU finns, annars CPU). "
+                 "Första körningen tar längre tid medan modellen exporteras."
+        )
+        if use_onnx and importlib.util.find_spec("optimum") is None:
+            st.warning("Paketet optimum[onnxruntime] saknas. TrOCR körs med PyTorch.")
+            use_onnx = False
+        
+        # Fler rader per batch går snabbare men kräver mer GPU-minne
+        recognition_batch_size = st.slider(
+            "TrOCR batch size",
+            min_value=1,
+            max_value=64,
+            value=RECOGNITION_BATCH_SIZE,
+            help="Antal textrader som avkodas samtidigt. Gäller standardkonfigurationen."
+        )
+        
+        # Pipeline-konfigurationen hålls i minnet; en anpassad version sparas i sessionen
+        pipeline_config = (
+            st.session_state.get("pipeline_config")
+            or create_pipeline_config(output_dir, recognition_batch_size)
+        )
+        pipeline_content = dump_pipeline_yaml(pipeline_config)
+        
+        with st.expander("Pipeline-konfiguration"):
+            st.code(pipeline_content, language="yaml")
+            
+            # Möjlighet att anpassa konfigurationen (enkel version)
+            if st.checkbox("Anpassa pipeline-konfigurationen"):
+                custom_pipeline = st.text_area(
+                    "Redigera pipeline.yaml (avancerat)", 
+                    value=pipeline_content,
+                    height=400
+                )
+                
+                if st.button("Uppdatera konfiguration"):
+                    try:
+                        custom_config = yaml.load(custom_pipeline, Loader=YAML_LOADER)
+                    except yaml.YAMLError as e:
+                        st.error(f"Ogiltig YAML: {e}")
+                    else:
+                        if is_valid_pipeline_config(custom_config):
+                            st.session_state.pipeline_config = custom_config
+                            st.success("Konfigurationen har uppdaterats!")
+                        else:
+                            st.error("Konfigurationen måste vara en mappning med en lista av steg under 'steps', "
+                                     "där varje stegs 'settings' är en mappning.")
+    
+    # Förladda den delade pipelinen så att första transkriberingen slipper vänta. Sessioner
+    # med samma modellkonfiguration delar cacheposten, så bara den första laddar modellerna
+    warm_key = pipeline_fingerprint(pipeline_config, use_onnx=use_onnx)
+    if success and not use_demo and st.session_state.get("warmed") != warm_key:
+        with st.spinner("Förladdar modeller..."):
+            try:
+                get_pipeline(pipeline_config, use_onnx)
+            except Exception as e:
+                st.warning(f"Kunde inte förladda modellerna: {e}")
+        st.session_state.warmed = warm_key
+    
+    # Huvudinnehållet - uppladdning och transkribering
+    transcribe_panel(temp_dir, output_dir, saved_files, pipeline_config, use_demo, precision, use_onnx)
 
 if __name__ == "__main__":
     main()